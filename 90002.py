@@ -11,10 +11,23 @@ from tkinter import ttk, scrolledtext, Menu, messagebox, PhotoImage, filedialog
 import ctypes
 import platform
 import threading
+import sqlite3
+import socket
+import argparse
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 from PIL import Image, ImageTk
 from io import BytesIO
 from collections import deque
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Константы
 CONFIG_FILE = "config.json"
 HISTORY_FILE = "prompt_history.json"
@@ -24,9 +37,36 @@ OUTPUT_FOLDER = "Generated_Images"
 MAX_FOLDER_NAME_LENGTH = 50
 THUMBNAIL_SIZE = (100, 100)
 MAX_THUMBNAILS = 5
+THUMBNAIL_FORMAT = "JPEG"
+THUMBNAIL_QUALITY = 85
 MAX_REPEATS = 1000
 MAX_HISTORY = 20
 TIME_ESTIMATE_PER_STEP = 5
+POLL_ATTEMPTS = 15
+POLL_INTERVAL = 5
+QUEUE_FILE = os.path.join(OUTPUT_FOLDER, "jobs.sqlite3")
+THUMBNAIL_CACHE_FILE = os.path.join(OUTPUT_FOLDER, "thumbnails.sqlite3")
+LEASE_SECONDS = 120
+HEARTBEAT_INTERVAL = 30
+QUEUE_POLL_INTERVAL = 5
+MAX_JOB_ATTEMPTS = 3
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_WORKERS = 2
+SERVER_POLL_INTERVAL = 1
+MAX_LONG_POLL = 60
+MAX_REQUEST_BODY = 64 * 1024
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+CONTACT_SHEET_FOLDER = "contact_sheets"
+CONTACT_SHEET_COLUMNS = 10
+CONTACT_SHEET_ROWS = 10
+CONTACT_SHEET_CELL = 160
+CONTACT_SHEET_GAP = 4
+CONTACT_SHEET_BACKGROUND = 32
+QUARANTINE_FOLDER = "quarantine"
+QUALITY_MIN_STDDEV = 5.0
+QUALITY_MIN_ENTROPY = 0.2
+QUALITY_MAX_RETRIES = 3
 
 SIZE_OPTIONS = [
 
@@ -41,6 +81,693 @@ SIZE_OPTIONS = [
     ("Custom", "custom")
 ]
 
+# Общий пул соединений к API для GUI, воркеров и HTTP-сервера
+HTTP_SESSION = requests.Session()
+
+def console_log(message, level="info"):
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    prefix = "ОШИБКА: " if level == "error" else ""
+    print(f"[{timestamp}] {prefix}{message}", flush=True)
+
+def read_config(path=CONFIG_FILE):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Файл {path} не найден!")
+
+    with open(path, "r") as f:
+        config = json.load(f)
+
+    if not all(k in config for k in ["api_key", "secret_key"]):
+        raise ValueError("Необходимы api_key и secret_key!")
+
+    return config["api_key"], config["secret_key"]
+
+def sanitize_folder_name(prompt):
+    name = re.sub(r'[<>:"/\\|?*]', '', prompt)
+    name = name.replace(' ', '_')
+    return name[:MAX_FOLDER_NAME_LENGTH] or "no_name"
+
+def prepare_output_folder(prompt, root=OUTPUT_FOLDER):
+    output_path = Path(root) / sanitize_folder_name(prompt)
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(output_path / "prompt.txt", "w", encoding="utf-8") as f:
+        f.write(prompt)
+    return output_path
+
+def api_headers(api_key, secret_key):
+    return {
+        "X-Key": f"Key {api_key}",
+        "X-Secret": f"Secret {secret_key}",
+    }
+
+def get_pipeline_id(headers):
+    response = HTTP_SESSION.get(
+        f"{API_URL}key/api/v1/pipelines", 
+        headers=headers,
+        timeout=10
+    )
+    response.raise_for_status()
+    return response.json()[0]["id"]
+
+def submit_generation(headers, pipeline_id, prompt, width, height):
+    params = {
+        "type": "GENERATE",
+        "numImages": 1,
+        "width": width,
+        "height": height,
+        "generateParams": {"query": prompt},
+    }
+    
+    response = HTTP_SESSION.post(
+        f"{API_URL}key/api/v1/pipeline/run",
+        headers=headers,
+        files={
+            "pipeline_id": (None, pipeline_id),
+            "params": (None, json.dumps(params), "application/json")
+        },
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()["uuid"]
+
+def wait_for_result(headers, task_id, should_stop=lambda: False, log=console_log):
+    """Опрос статуса задачи. Возвращает result из ответа API (files, censored) или None при остановке"""
+    for attempt in range(POLL_ATTEMPTS):
+        if should_stop():
+            log("Генерация прервана пользователем")
+            return None
+            
+        try:
+            status = HTTP_SESSION.get(
+                f"{API_URL}key/api/v1/pipeline/status/{task_id}",
+                headers=headers,
+                timeout=10
+            ).json()
+            
+            if status["status"] == "DONE":
+                return status["result"]
+            elif status["status"] == "FAILED":
+                raise RuntimeError(status.get("error", "Ошибка генерации"))
+            
+            time.sleep(POLL_INTERVAL)
+            log(f"Ожидание... (попытка {attempt+1}/{POLL_ATTEMPTS})")
+        except Exception as e:
+            if attempt == POLL_ATTEMPTS - 1:
+                raise TimeoutError("Таймаут ожидания")
+            time.sleep(POLL_INTERVAL)
+
+    raise TimeoutError("Таймаут ожидания")
+
+def output_key(path):
+    """Ключ результата без размера: уменьшенные копии отличаются от оригинала только WxH в имени"""
+    stem = Path(path).stem
+    match = re.match(r"(.+)_\d+x\d+_(\d+)$", stem)
+    return match.groups() if match else stem
+
+def save_result(output_path, image_data, width, height, index, timestamp=None):
+    timestamp = timestamp or datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = output_path / f"{timestamp}_{width}x{height}_{index}.png"
+    
+    with open(filename, "wb") as f:
+        f.write(base64.b64decode(image_data))
+    return filename
+
+def check_image_quality(path):
+    """Быстрая проверка результата на миниатюре, полученной за одно декодирование файла.
+    Возвращает (причина брака или None, миниатюра THUMBNAIL_SIZE для кэша)"""
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        with Image.open(path) as img:
+            # Полное декодирование ловит обрезанные файлы, reducing_gap ускоряет уменьшение
+            img.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS, reducing_gap=2.0)
+            thumbnail = img.convert("RGB")
+    except Exception as e:
+        return f"файл повреждён ({str(e)})", None
+
+    if np is None:
+        return None, thumbnail
+
+    pixels = np.asarray(thumbnail.convert("L"))
+    stddev = float(pixels.std())
+    hist = np.bincount(pixels.ravel(), minlength=256) / pixels.size
+    hist = hist[hist > 0]
+    entropy = max(0.0, float(-(hist * np.log2(hist)).sum()))
+    if stddev < QUALITY_MIN_STDDEV:
+        return f"почти однотонное изображение (σ={stddev:.1f})", thumbnail
+    # Порог энтропии ловит один цвет почти на всём кадре, но пропускает контурные рисунки и логотипы
+    if entropy < QUALITY_MIN_ENTROPY:
+        return f"почти всё изображение одного цвета (энтропия {entropy:.2f} бит)", thumbnail
+
+    return None, thumbnail
+
+def quarantine_image(path):
+    path = Path(path)
+    quarantine_path = path.parent / QUARANTINE_FOLDER
+    quarantine_path.mkdir(exist_ok=True)
+    target = quarantine_path / path.name
+    n = 1
+    while target.exists():
+        n += 1
+        target = quarantine_path / f"{path.stem}_{n}{path.suffix}"
+    os.replace(path, target)
+    return target
+
+class QualityGateError(RuntimeError):
+    pass
+
+def generate_checked(headers, pipeline_id, prompt, width, height, output_path, index,
+                     should_stop=lambda: False, log=console_log, timestamp=None):
+    """Генерация с проверкой качества: брак уходит в карантин и запрашивается заново.
+    Возвращает (путь к годному изображению, его миниатюра) или (None, None) при остановке"""
+    for attempt in range(QUALITY_MAX_RETRIES + 1):
+        task_id = submit_generation(headers, pipeline_id, prompt, width, height)
+        log(f"Задача создана, ID: {task_id}")
+
+        result = wait_for_result(headers, task_id, should_stop=should_stop, log=log)
+        if result is None:
+            return None, None
+
+        filename = save_result(output_path, result["files"][0], width, height, index, timestamp)
+        if result.get("censored"):
+            problem = "изображение скрыто цензурой"
+        else:
+            problem, thumbnail = check_image_quality(filename)
+        if problem is None:
+            return filename, thumbnail
+
+        quarantined = quarantine_image(filename)
+        log(f"Брак: {problem}. Файл перемещён в {quarantined}", "error")
+        if attempt < QUALITY_MAX_RETRIES:
+            log(f"Повторный запрос ({attempt+1}/{QUALITY_MAX_RETRIES})")
+
+    raise QualityGateError(f"Не удалось получить годное изображение за {QUALITY_MAX_RETRIES + 1} попыток")
+
+@contextmanager
+def sqlite_transaction(path, immediate=True):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        # IMMEDIATE сразу берёт блокировку записи, чтобы два воркера не забрали одно задание
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+class JobQueue:
+    """Общая очередь заданий в SQLite с арендой (lease) и heartbeat.
+    Результаты сохраняются в папку очереди (output_root), в базе пути хранятся относительно неё"""
+
+    def __init__(self, path=QUEUE_FILE):
+        self.path = str(path)
+        self.output_root = Path(self.path).parent
+        self.output_root.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    prompt TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        # Журнал WAL не включается: он требует общей памяти и не работает на сетевых ФС,
+        # через которые очередь делят воркеры на разных машинах
+
+    def _transaction(self):
+        return sqlite_transaction(self.path)
+
+    def submit(self, prompt, width, height, count=1):
+        now = time.time()
+        with self._transaction() as conn:
+            return [
+                conn.execute(
+                    "INSERT INTO jobs (prompt, width, height, created, updated) VALUES (?, ?, ?, ?, ?)",
+                    (prompt, width, height, now, now)
+                ).lastrowid
+                for _ in range(count)
+            ]
+
+    def claim(self, worker_id, lease=LEASE_SECONDS):
+        """Забрать следующее задание: ожидающее или с истёкшей арендой"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, worker = NULL, updated = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                ("Превышено число попыток", now, now, MAX_JOB_ATTEMPTS)
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'pending' "
+                "OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker_id, now + lease, now, row["id"])
+            )
+            job = dict(row)
+            job.update(status="running", worker=worker_id, attempts=row["attempts"] + 1)
+            return job
+
+    def heartbeat(self, job_id, worker_id, lease=LEASE_SECONDS):
+        """Продлить аренду. False, если задание уже перехвачено другим воркером"""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + lease, now, job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        """Отметить задание выполненным. False, если задание уже перехвачено другим воркером"""
+        result = Path(os.path.relpath(result, self.output_root)).as_posix()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (result, time.time(), job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def result_path(self, job):
+        return self.output_root / job["result"] if job["result"] else None
+
+    def fail(self, job_id, worker_id, error):
+        """Вернуть задание в очередь или пометить как failed после MAX_JOB_ATTEMPTS попыток"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL, error = ?, updated = ? WHERE id = ? AND worker = ?",
+                (MAX_JOB_ATTEMPTS, str(error), time.time(), job_id, worker_id)
+            )
+
+    def release(self, job_id, worker_id):
+        """Вернуть задание в очередь без учёта попытки (остановка воркера)"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'pending', worker = NULL, lease_until = NULL, "
+                "attempts = attempts - 1, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), job_id, worker_id)
+            )
+
+    def get(self, job_id):
+        with sqlite_transaction(self.path, immediate=False) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return dict(row) if row else None
+
+    def stats(self):
+        with sqlite_transaction(self.path, immediate=False) as conn:
+            return {
+                row["status"]: row["total"]
+                for row in conn.execute("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status")
+            }
+
+def _heartbeat_loop(queue, job_id, worker_id, done, lost, log):
+    while not done.wait(HEARTBEAT_INTERVAL):
+        try:
+            if not queue.heartbeat(job_id, worker_id):
+                log(f"Аренда задания {job_id} потеряна", "error")
+                lost.set()
+                return
+        except sqlite3.Error as e:
+            log(f"Ошибка heartbeat: {str(e)}", "error")
+
+def run_worker(queue, api_key, secret_key, worker_id=None, stop_event=None, once=False, log=console_log):
+    """Безголовый воркер: забирает задания из общей очереди и сохраняет результат в её папку"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    stop_event = stop_event or threading.Event()
+    headers = api_headers(api_key, secret_key)
+    thumbnail_cache = ThumbnailCache(queue.output_root / os.path.basename(THUMBNAIL_CACHE_FILE))
+    pipeline_id = None
+    log(f"Воркер {worker_id} запущен, очередь: {queue.path}")
+
+    while not stop_event.is_set():
+        job = queue.claim(worker_id)
+        if job is None:
+            if once:
+                break
+            stop_event.wait(QUEUE_POLL_INTERVAL)
+            continue
+
+        log(f"Задание {job['id']} (попытка {job['attempts']}): '{job['prompt']}'")
+        done = threading.Event()
+        lost = threading.Event()
+        threading.Thread(
+            target=_heartbeat_loop,
+            args=(queue, job["id"], worker_id, done, lost, log),
+            daemon=True
+        ).start()
+        try:
+            if pipeline_id is None:
+                pipeline_id = get_pipeline_id(headers)
+            output_path = prepare_output_folder(job["prompt"], queue.output_root)
+            filename, thumbnail = generate_checked(
+                headers, pipeline_id, job["prompt"], job["width"], job["height"], output_path, job["id"],
+                should_stop=lambda: stop_event.is_set() or lost.is_set(), log=log
+            )
+            if lost.is_set():
+                log(f"Задание {job['id']} перехвачено другим воркером, генерация прервана", "error")
+                continue
+            if filename is None:
+                queue.release(job["id"], worker_id)
+                break
+            if not queue.complete(job["id"], worker_id, filename):
+                log(f"Задание {job['id']} перехвачено другим воркером, результат не засчитан", "error")
+                continue
+            log(f"Изображение сохранено: {filename}")
+            try:
+                thumbnail_cache.put(filename, thumbnail)
+            except Exception as e:
+                log(f"Ошибка создания миниатюры: {str(e)}", "error")
+        except KeyboardInterrupt:
+            queue.release(job["id"], worker_id)
+            raise
+        except Exception as e:
+            pipeline_id = None
+            queue.fail(job["id"], worker_id, e)
+            log(f"Ошибка задания {job['id']}: {str(e)}", "error")
+        finally:
+            done.set()
+
+    log(f"Воркер {worker_id} остановлен")
+
+def load_downscaled(path, size):
+    """Уменьшенная копия изображения. PNG декодируется целиком (draft работает только для JPEG),
+    затем reducing_gap ужимает его быстрым reduce() перед финальным LANCZOS"""
+    with Image.open(path) as img:
+        img.thumbnail(size, Image.LANCZOS, reducing_gap=2.0)
+        return img.convert("RGB")
+
+def build_contact_sheets(folder, columns=CONTACT_SHEET_COLUMNS, rows=CONTACT_SHEET_ROWS, cell=CONTACT_SHEET_CELL, log=console_log):
+    """Собрать изображения папки в постраничные сетки contact_sheets/sheet_NNN.png"""
+    if np is None:
+        raise ImportError("Для контактных листов установите numpy: pip install numpy")
+
+    folder = Path(folder)
+    images = sorted(p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+    if not images:
+        log(f"В папке {folder} нет изображений", "error")
+        return []
+
+    output_path = folder / CONTACT_SHEET_FOLDER
+    output_path.mkdir(exist_ok=True)
+    thumb_size = (cell - 2 * CONTACT_SHEET_GAP, cell - 2 * CONTACT_SHEET_GAP)
+    per_page = columns * rows
+    sheets = []
+
+    def decode(path):
+        try:
+            return np.asarray(load_downscaled(path, thumb_size))
+        except Exception as e:
+            log(f"Не удалось прочитать {path.name}: {str(e)}", "error")
+            return None
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+        for page, start in enumerate(range(0, len(images), per_page), 1):
+            batch = images[start:start + per_page]
+            used_rows = -(-len(batch) // columns)
+            # В памяти только одна страница: холст и миниатюры текущей партии
+            sheet = np.full((used_rows * cell, columns * cell, 3), CONTACT_SHEET_BACKGROUND, dtype=np.uint8)
+            for idx, thumb in enumerate(executor.map(decode, batch)):
+                if thumb is None:
+                    continue
+                h, w = thumb.shape[:2]
+                row, col = divmod(idx, columns)
+                y = row * cell + (cell - h) // 2
+                x = col * cell + (cell - w) // 2
+                sheet[y:y + h, x:x + w] = thumb
+
+            filename = output_path / f"sheet_{page:03d}.png"
+            Image.fromarray(sheet).save(filename)
+            sheets.append(filename)
+            log(f"Контактный лист сохранён: {filename} ({len(batch)} изображений)")
+
+    return sheets
+
+class ThumbnailCache:
+    """Постоянный кэш миниатюр в SQLite, ключ: путь, mtime и размер файла"""
+
+    def __init__(self, path=THUMBNAIL_CACHE_FILE):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with sqlite_transaction(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    created REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS thumbnails_mtime ON thumbnails (mtime_ns)")
+
+    @staticmethod
+    def _key(image_path):
+        image_path = os.path.abspath(image_path)
+        stat = os.stat(image_path)
+        return image_path, stat.st_mtime_ns, stat.st_size
+
+    def store(self, image_path):
+        """Создать и сохранить миниатюру. Вызывать вне потока интерфейса"""
+        return self.put(image_path, load_downscaled(image_path, THUMBNAIL_SIZE))
+
+    def put(self, image_path, img):
+        """Сохранить уже готовую миниатюру, например полученную при проверке качества"""
+        key = self._key(image_path)
+        buffer = BytesIO()
+        img.save(buffer, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+        with sqlite_transaction(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO thumbnails (path, mtime_ns, size, data, created) VALUES (?, ?, ?, ?, ?)",
+                (*key, buffer.getvalue(), time.time())
+            )
+        return img
+
+    def get(self, image_path):
+        """Миниатюра из кэша; устаревшая или отсутствующая создаётся заново"""
+        key = self._key(image_path)
+        with sqlite_transaction(self.path, immediate=False) as conn:
+            row = conn.execute(
+                "SELECT data FROM thumbnails WHERE path = ? AND mtime_ns = ? AND size = ?", key
+            ).fetchone()
+        if row is None:
+            return self.store(image_path)
+        img = Image.open(BytesIO(row["data"]))
+        img.load()
+        return img
+
+    def recent(self, limit=MAX_THUMBNAILS):
+        """Миниатюры самых новых файлов (по mtime самого файла, а не времени записи в кэш).
+        Записи удалённых и изменённых файлов удаляются из кэша"""
+        result = {}
+        stale = []
+        with sqlite_transaction(self.path, immediate=False) as conn:
+            keys = conn.execute(
+                "SELECT path, mtime_ns, size FROM thumbnails ORDER BY mtime_ns DESC"
+            ).fetchall()
+            for row in keys:
+                key = tuple(row)
+                try:
+                    if self._key(row["path"]) != key:
+                        stale.append(key)
+                        continue
+                except OSError:
+                    stale.append(key)
+                    continue
+                if output_key(row["path"]) in result:
+                    continue
+                data = conn.execute("SELECT data FROM thumbnails WHERE path = ?", (row["path"],)).fetchone()["data"]
+                img = Image.open(BytesIO(data))
+                img.load()
+                result[output_key(row["path"])] = (row["path"], img)
+                if len(result) >= limit:
+                    break
+
+        if stale:
+            with sqlite_transaction(self.path) as conn:
+                conn.executemany(
+                    "DELETE FROM thumbnails WHERE path = ? AND mtime_ns = ? AND size = ?", stale
+                )
+        return list(result.values())
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Локальный HTTP API поверх JobQueue: отправка заданий, статус (long-poll/SSE), скачивание"""
+    queue = None
+
+    def log_message(self, format, *args):
+        console_log(f"HTTP {self.address_string()} {format % args}")
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        return parts, parse_qs(url.query)
+
+    def _job_or_404(self, job_id):
+        job = self.queue.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self._send_json(404, {"error": "Задание не найдено"})
+        return job
+
+    def _wait_for_change(self, job, timeout):
+        """Ждать смены статуса задания или завершения, не дольше timeout секунд"""
+        deadline = time.time() + timeout
+        while job["status"] not in ("done", "failed") and time.time() < deadline:
+            time.sleep(SERVER_POLL_INTERVAL)
+            current = self.queue.get(job["id"])
+            if current["status"] != job["status"] or current["updated"] != job["updated"]:
+                return current
+        return job
+
+    def do_POST(self):
+        parts, _ = self._route()
+        if parts != ["jobs"]:
+            self._send_json(404, {"error": "Неизвестный адрес"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_json(400, {"error": "Некорректный Content-Length"})
+            return
+        if length > MAX_REQUEST_BODY:
+            self._send_json(413, {"error": "Слишком большой запрос"})
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+            prompt = str(data.get("prompt", "")).strip()
+            width = int(data.get("width", DEFAULT_SIZE))
+            height = int(data.get("height", width))
+            count = int(data.get("count", 1))
+        except (ValueError, TypeError, AttributeError, OverflowError):
+            self._send_json(400, {"error": "Некорректный JSON"})
+            return
+
+        if not prompt:
+            self._send_json(400, {"error": "Не указан prompt"})
+        elif not (64 <= width <= 4096 and 64 <= height <= 4096):
+            self._send_json(400, {"error": "Размер должен быть от 64 до 4096 пикселей"})
+        elif not 1 <= count <= MAX_REPEATS:
+            self._send_json(400, {"error": f"count должно быть от 1 до {MAX_REPEATS}"})
+        else:
+            self._send_json(201, {"jobs": self.queue.submit(prompt, width, height, count)})
+
+    def do_GET(self):
+        parts, query = self._route()
+
+        if parts == ["queue"]:
+            self._send_json(200, self.queue.stats())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self._job_or_404(parts[1])
+            if job is not None:
+                try:
+                    wait = min(float(query.get("wait", ["0"])[0]), MAX_LONG_POLL)
+                except ValueError:
+                    self._send_json(400, {"error": "Некорректный параметр wait"})
+                    return
+                self._send_json(200, self._wait_for_change(job, wait) if wait > 0 else job)
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            job = self._job_or_404(parts[1])
+            if job is not None:
+                self._stream_events(job)
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result":
+            job = self._job_or_404(parts[1])
+            if job is not None:
+                self._send_result(job)
+        else:
+            self._send_json(404, {"error": "Неизвестный адрес"})
+
+    def _stream_events(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                payload = json.dumps(job, ensure_ascii=False)
+                self.wfile.write(f"event: status\ndata: {payload}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if job["status"] in ("done", "failed"):
+                    break
+                job = self._wait_for_change(job, MAX_LONG_POLL)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_result(self, job):
+        if job["status"] != "done":
+            self._send_json(409, {"error": "Задание ещё не выполнено", "status": job["status"]})
+            return
+        result_path = self.queue.result_path(job)
+        try:
+            with open(result_path, "rb") as f:
+                body = f.read()
+        except OSError:
+            self._send_json(410, {"error": "Файл результата не найден"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Disposition", f'attachment; filename="{result_path.name}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+def run_server(queue, api_key, secret_key, host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS):
+    """HTTP-сервер и встроенные воркеры с общим набором ключей"""
+    stop_event = threading.Event()
+    threads = []
+    for n in range(workers):
+        thread = threading.Thread(
+            target=run_worker,
+            args=(queue, api_key, secret_key, f"{socket.gethostname()}-{os.getpid()}-http{n+1}", stop_event),
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    handler = type("BoundJobRequestHandler", (JobRequestHandler,), {"queue": queue})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    console_log(f"HTTP-сервер запущен: http://{host}:{port}/ (воркеров: {workers})")
+    try:
+        server.serve_forever()
+    finally:
+        stop_event.set()
+        server.server_close()
+        # Дождаться, пока воркеры вернут незавершённые задания в очередь
+        console_log("Остановка воркеров...")
+        for thread in threads:
+            thread.join()
+
 class SmartTextWidget(scrolledtext.ScrolledText):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -78,6 +805,7 @@ class ImageGenerator:
         self.repeat_generation = tk.BooleanVar(value=False)
         self.repeat_count = tk.IntVar(value=1)
         self.last_generated_images = []
+        self.thumbnail_cache = ThumbnailCache()
         self.current_repeat = 0
         self.prompt_history = deque(maxlen=MAX_HISTORY)
         self.start_time = None
@@ -93,6 +821,7 @@ class ImageGenerator:
         
         # Обновляем меню после загрузки истории
         self.update_history_menu()
+        self.load_recent_thumbnails()
         
         self.setup_hotkeys()
 
@@ -269,6 +998,7 @@ class ImageGenerator:
         
         self.generate_btn.config(state=state)
         self.stop_btn.config(state=tk.NORMAL if generating else tk.DISABLED)
+        self.enqueue_btn.config(state=state)
         self.clear_btn.config(state=state)
         self.prompt_text.config(state=state)
         self.size_combobox.config(state=state)
@@ -345,14 +1075,8 @@ class ImageGenerator:
         if self.size_var.get() == "Custom" and not self.validate_custom_size():
             return
 
-        try:
-            repeat_count = int(self.repeat_entry.get())
-            if repeat_count < 1 or repeat_count > MAX_REPEATS:
-                messagebox.showerror("Ошибка", f"Количество повторений должно быть от 1 до {MAX_REPEATS}")
-                return
-            self.repeat_count.set(repeat_count)
-        except ValueError:
-            messagebox.showerror("Ошибка", "Введите корректное число повторений")
+        repeat_count = self.read_repeat_count()
+        if repeat_count is None:
             return
 
         self.add_to_history(prompt)
@@ -369,6 +1093,64 @@ class ImageGenerator:
         )
         thread.start()
 
+    def read_repeat_count(self):
+        try:
+            repeat_count = int(self.repeat_entry.get())
+            if repeat_count < 1 or repeat_count > MAX_REPEATS:
+                messagebox.showerror("Ошибка", f"Количество повторений должно быть от 1 до {MAX_REPEATS}")
+                return None
+            self.repeat_count.set(repeat_count)
+            return repeat_count
+        except ValueError:
+            messagebox.showerror("Ошибка", "Введите корректное число повторений")
+            return None
+
+    def enqueue_prompt(self):
+        """Добавить промпт в общую очередь для безголовых воркеров (--worker)"""
+        prompt = self.get_prompt()
+        if not prompt:
+            self.log_message("Ошибка: не введен промпт", "error")
+            return
+            
+        if self.size_var.get() == "Custom" and not self.validate_custom_size():
+            return
+
+        repeat_count = self.read_repeat_count()
+        if repeat_count is None:
+            return
+        count = repeat_count if self.repeat_generation.get() else 1
+
+        try:
+            width, height = self.get_generation_size()
+            job_ids = JobQueue().submit(prompt, width, height, count)
+            self.add_to_history(prompt)
+            self.log_message(f"В очередь добавлено заданий: {len(job_ids)} (ID {job_ids[0]}-{job_ids[-1]})")
+        except sqlite3.Error as e:
+            self.log_message(f"Ошибка очереди: {str(e)}", "error")
+
+    def create_contact_sheet(self):
+        folder = filedialog.askdirectory(
+            title="Папка с изображениями",
+            initialdir=OUTPUT_FOLDER if os.path.isdir(OUTPUT_FOLDER) else "."
+        )
+        if not folder:
+            return
+
+        self.log_message(f"Создание контактных листов: {folder}")
+        threading.Thread(
+            target=self._contact_sheet_thread,
+            args=(folder,),
+            daemon=True
+        ).start()
+
+    def _contact_sheet_thread(self, folder):
+        try:
+            sheets = build_contact_sheets(folder, log=self._thread_log)
+            if sheets:
+                self.root.after(0, self.open_image, sheets[0])
+        except Exception as e:
+            self._thread_log(f"Ошибка создания контактных листов: {str(e)}", "error")
+
     def add_to_history(self, prompt):
         if prompt and prompt not in self.prompt_history:
             self.prompt_history.appendleft(prompt)
@@ -379,6 +1161,10 @@ class ImageGenerator:
         self.prompt_text.delete("1.0", tk.END)
         self.prompt_text.insert("1.0", prompt)
         self.log_message(f"Загружен промпт из истории: {prompt[:50]}...")
+        self.show_prompt_thumbnails(prompt)
+
+    def _thread_log(self, message, level="info"):
+        self.root.after(0, self.log_message, message, level)
 
     def _generate_image_thread(self, prompt):
         try:
@@ -388,28 +1174,12 @@ class ImageGenerator:
             width, height = self.get_generation_size()
             self.root.after(0, self.log_message, f"Размер изображения: {width}x{height}")
             
-            folder_name = self.sanitize_folder_name(prompt)
-            output_path = Path(OUTPUT_FOLDER) / folder_name
-            output_path.mkdir(parents=True, exist_ok=True)
+            output_path = prepare_output_folder(prompt)
             self.root.after(0, self.log_message, f"Папка создана: {output_path}")
-            
-            prompt_file = output_path / "prompt.txt"
-            with open(prompt_file, "w", encoding="utf-8") as f:
-                f.write(prompt)
-            self.root.after(0, self.log_message, f"Промпт сохранён: {prompt_file}")
-
-            headers = {
-                "X-Key": f"Key {self.api_key}",
-                "X-Secret": f"Secret {self.secret_key}",
-            }
-            
-            response = requests.get(
-                f"{API_URL}key/api/v1/pipelines", 
-                headers=headers,
-                timeout=10
-            )
-            response.raise_for_status()
-            pipeline_id = response.json()[0]["id"]
+            self.root.after(0, self.log_message, f"Промпт сохранён: {output_path / 'prompt.txt'}")
+
+            headers = api_headers(self.api_key, self.secret_key)
+            pipeline_id = get_pipeline_id(headers)
             self.root.after(0, self.log_message, f"Pipeline ID: {pipeline_id}")
 
             repeat_times = self.repeat_count.get() if self.repeat_generation.get() else 1
@@ -424,61 +1194,27 @@ class ImageGenerator:
                 if repeat_times > 1:
                     self.root.after(0, self.log_message, f"Повторение {self.current_repeat} из {repeat_times}")
 
-                params = {
-                    "type": "GENERATE",
-                    "numImages": 1,
-                    "width": width,
-                    "height": height,
-                    "generateParams": {"query": prompt},
-                }
-                
-                response = requests.post(
-                    f"{API_URL}key/api/v1/pipeline/run",
-                    headers=headers,
-                    files={
-                        "pipeline_id": (None, pipeline_id),
-                        "params": (None, json.dumps(params), "application/json")
-                    },
-                    timeout=30
-                )
-                response.raise_for_status()
-                task_id = response.json()["uuid"]
-                self.root.after(0, self.log_message, f"Задача создана, ID: {task_id}")
-
-                for attempt in range(15):
-                    if self.should_stop:
-                        self.root.after(0, self.log_message, "Генерация прервана пользователем")
-                        break
-                        
-                    try:
-                        status = requests.get(
-                            f"{API_URL}key/api/v1/pipeline/status/{task_id}",
-                            headers=headers,
-                            timeout=10
-                        ).json()
-                        
-                        if status["status"] == "DONE":
-                            image_data = status["result"]["files"][0]
-                            break
-                        elif status["status"] == "FAILED":
-                            raise RuntimeError(status.get("error", "Ошибка генерации"))
-                        
-                        time.sleep(5)
-                        self.root.after(0, self.log_message, f"Ожидание... (попытка {attempt+1}/15)")
-                    except Exception as e:
-                        if attempt == 14:
-                            raise TimeoutError("Таймаут ожидания")
-                        time.sleep(5)
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                try:
+                    filename, thumbnail = generate_checked(
+                        headers, pipeline_id, prompt, width, height, output_path, i+1,
+                        should_stop=lambda: self.should_stop,
+                        log=self._thread_log,
+                        timestamp=timestamp
+                    )
+                except QualityGateError as e:
+                    self.root.after(0, self.log_message, f"Повторение {i+1} пропущено: {str(e)}", "error")
+                    self.root.after(0, self.log_message, "="*50)
+                    continue
 
-                if not self.should_stop:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = output_path / f"{timestamp}_{width}x{height}_{i+1}.png"
-                    
-                    with open(filename, "wb") as f:
-                        f.write(base64.b64decode(image_data))
+                if filename is not None:
 
                     self.root.after(0, self.log_message, f"Изображение сохранено: {filename}")
-                    self.root.after(0, self.add_thumbnail, filename)
+                    try:
+                        self.thumbnail_cache.put(filename, thumbnail)
+                        self.root.after(0, self.add_thumbnail, filename, thumbnail)
+                    except Exception as e:
+                        self.root.after(0, self.log_message, f"Ошибка создания миниатюры: {str(e)}", "error")
                     
                     if not self.save_original_size.get():
                         try:
@@ -511,10 +1247,10 @@ class ImageGenerator:
         else:
             self.repeat_counter.config(text="")
 
-    def add_thumbnail(self, image_path):
+    def add_thumbnail(self, image_path, img=None):
         try:
-            img = Image.open(image_path)
-            img.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+            if img is None:
+                img = self.thumbnail_cache.get(image_path)
             photo = ImageTk.PhotoImage(img)
             self.last_generated_images.insert(0, (photo, str(image_path)))
             
@@ -526,6 +1262,49 @@ class ImageGenerator:
         except Exception as e:
             self.log_message(f"Ошибка создания миниатюры: {str(e)}", "error")
 
+    def set_thumbnails(self, items):
+        """Заменить ленту миниатюр списком (путь, миниатюра PIL)"""
+        self.last_generated_images = [
+            (ImageTk.PhotoImage(img), str(path)) for path, img in items[:MAX_THUMBNAILS]
+        ]
+        self.update_thumbnails()
+
+    def load_recent_thumbnails(self):
+        def worker():
+            try:
+                items = self.thumbnail_cache.recent(MAX_THUMBNAILS)
+                if items:
+                    self.root.after(0, self.set_thumbnails, items)
+            except Exception as e:
+                self._thread_log(f"Ошибка загрузки миниатюр: {str(e)}", "error")
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def show_prompt_thumbnails(self, prompt):
+        """Показать последние результаты промпта; недостающие миниатюры создаются в фоне"""
+        folder = Path(OUTPUT_FOLDER) / sanitize_folder_name(prompt)
+        if not folder.is_dir():
+            return
+
+        def worker():
+            try:
+                images = sorted(
+                    (p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS),
+                    reverse=True
+                )
+                unique = {}
+                for path in images:
+                    unique.setdefault(output_key(path), path)
+                    if len(unique) >= MAX_THUMBNAILS:
+                        break
+                items = [(path, self.thumbnail_cache.get(path)) for path in unique.values()]
+                if items:
+                    self.root.after(0, self.set_thumbnails, items)
+            except Exception as e:
+                self._thread_log(f"Ошибка загрузки миниатюр: {str(e)}", "error")
+
+        threading.Thread(target=worker, daemon=True).start()
+
     def update_thumbnails(self):
         for widget in self.thumbnails_frame.winfo_children():
             widget.destroy()
@@ -559,23 +1338,11 @@ class ImageGenerator:
         return (1024, 1024)
 
     def sanitize_folder_name(self, prompt):
-        name = re.sub(r'[<>:"/\\|?*]', '', prompt)
-        name = name.replace(' ', '_')
-        return name[:MAX_FOLDER_NAME_LENGTH] or "no_name"
+        return sanitize_folder_name(prompt)
 
     def load_config(self):
         try:
-            if not os.path.exists(CONFIG_FILE):
-                raise FileNotFoundError(f"Файл {CONFIG_FILE} не найден!")
-
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
-
-            if not all(k in config for k in ["api_key", "secret_key"]):
-                raise ValueError("Необходимы api_key и secret_key!")
-
-            self.api_key = config["api_key"]
-            self.secret_key = config["secret_key"]
+            self.api_key, self.secret_key = read_config()
             return True
 
         except Exception as e:
@@ -720,6 +1487,20 @@ class ImageGenerator:
         )
         self.stop_btn.pack(side=tk.LEFT, padx=5)
         
+        self.enqueue_btn = ttk.Button(
+            button_frame,
+            text="В очередь",
+            command=self.enqueue_prompt
+        )
+        self.enqueue_btn.pack(side=tk.LEFT, padx=5)
+        
+        self.contact_sheet_btn = ttk.Button(
+            button_frame,
+            text="Контактный лист",
+            command=self.create_contact_sheet
+        )
+        self.contact_sheet_btn.pack(side=tk.LEFT, padx=5)
+        
         self.clear_btn = ttk.Button(
             button_frame,
             text="Очистить",
@@ -752,7 +1533,60 @@ class ImageGenerator:
         self.log_area.pack(fill=tk.BOTH, expand=True)
         self.log_area.bind("<Button-3>", self.show_log_context_menu)
 
+def parse_size(value):
+    width, _, height = value.lower().partition("x")
+    width, height = int(width), int(height or width)
+    if not (64 <= width <= 4096 and 64 <= height <= 4096):
+        raise argparse.ArgumentTypeError("размер должен быть от 64 до 4096 пикселей")
+    return width, height
+
+def main():
+    parser = argparse.ArgumentParser(description="FusionBrain Image Generator")
+    parser.add_argument("--worker", action="store_true", help="запустить безголовый воркер общей очереди")
+    parser.add_argument("--enqueue", metavar="PROMPT", help="добавить промпт в общую очередь")
+    parser.add_argument("--count", type=int, default=1, help="количество изображений для --enqueue")
+    parser.add_argument("--size", type=parse_size, default=(DEFAULT_SIZE, DEFAULT_SIZE), help="размер, например 1024 или 1024x768")
+    parser.add_argument("--contact-sheet", metavar="FOLDER", help="собрать контактные листы для папки с изображениями")
+    parser.add_argument("--queue-status", action="store_true", help="показать состояние очереди")
+    parser.add_argument("--queue", default=QUEUE_FILE, help="путь к файлу очереди; результаты сохраняются в его папку")
+    parser.add_argument("--serve", action="store_true", help="запустить локальный HTTP-сервис заданий")
+    parser.add_argument("--host", default=SERVER_HOST, help="адрес HTTP-сервиса")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="порт HTTP-сервиса")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="число воркеров HTTP-сервиса")
+    parser.add_argument("--worker-id", help="идентификатор воркера")
+    parser.add_argument("--once", action="store_true", help="завершить воркер, когда очередь опустеет")
+    args = parser.parse_args()
+
+    if args.enqueue:
+        if not 1 <= args.count <= MAX_REPEATS:
+            parser.error(f"--count должно быть от 1 до {MAX_REPEATS}")
+        job_ids = JobQueue(args.queue).submit(args.enqueue, *args.size, args.count)
+        console_log(f"В очередь добавлено заданий: {len(job_ids)} (ID {job_ids[0]}-{job_ids[-1]})")
+    elif args.contact_sheet:
+        try:
+            build_contact_sheets(args.contact_sheet)
+        except (OSError, ImportError) as e:
+            console_log(f"Ошибка создания контактных листов: {str(e)}", "error")
+    elif args.queue_status:
+        for status, total in sorted(JobQueue(args.queue).stats().items()):
+            print(f"{status}: {total}")
+    elif args.serve:
+        api_key, secret_key = read_config()
+        try:
+            run_server(JobQueue(args.queue), api_key, secret_key, args.host, args.port, args.workers)
+        except KeyboardInterrupt:
+            console_log("HTTP-сервер остановлен")
+    elif args.worker:
+        api_key, secret_key = read_config()
+        stop_event = threading.Event()
+        try:
+            run_worker(JobQueue(args.queue), api_key, secret_key, args.worker_id, stop_event, args.once)
+        except KeyboardInterrupt:
+            console_log("Воркер остановлен пользователем")
+    else:
+        root = tk.Tk()
+        app = ImageGenerator(root)
+        root.mainloop()
+
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = ImageGenerator(root)
-    root.mainloop()
\ No newline at end of file
+    main()
\ No newline at end of file